@@ -1,110 +1,475 @@
+import io
+import base64
+import hashlib
+import uuid
 import os
+import time
+import secrets
+import queue
+import random
 import asyncio
+import logging
+import logging.handlers
 from typing import Optional, List
+from datetime import datetime
 from contextlib import asynccontextmanager
+from collections import defaultdict
 
-from fastapi import FastAPI, HTTPException, Response
+from fastapi import FastAPI, HTTPException, Response, Depends, Query, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse, ORJSONResponse
+from pydantic import BaseModel, ConfigDict
 
 from dotenv import load_dotenv
-from supabase import create_client, Client
+import asyncpg
+import orjson
 
 from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, LabeledPrice, PreCheckoutQuery, ContentType
+from aiogram.types import Update, Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, LabeledPrice, PreCheckoutQuery, ContentType
 from aiogram.filters import CommandStart, CommandObject
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter
 import aiohttp 
 
 # --- CONFIGURATION ---
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+PG_DSN = os.getenv("PG_DSN")
+TG_FILE_PREFIX = f"https://api.telegram.org/file/bot{BOT_TOKEN}/"
 ADMIN_USERNAME = "astermaneiro"
+# Looked up by ADMIN_USERNAME (see resolve_admin_id) when not set explicitly
+ADMIN_ID = int(os.getenv("ADMIN_ID", 0)) or None
+PUBLIC_URL = os.getenv("PUBLIC_URL", "").rstrip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", 1))
+FRONTEND_ORIGINS = os.getenv("FRONTEND_ORIGINS", "https://tg-cloud-frontend.vercel.app").split(",")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
+log = logging.getLogger(__name__)
 
 # --- HELPER FUNCTIONS ---
 
-def check_is_blocked(user_id: int):
+EXT_KIND = {'.jpg': 'photo', '.jpeg': 'photo', '.png': 'photo', '.mp4': 'video', '.mov': 'video'}
+
+def file_kind(name: str) -> str:
+    """Classifies a file name as 'photo', 'video' or 'doc' by its extension."""
+    return EXT_KIND.get(name[name.rfind('.'):].lower(), 'doc')
+
+def sniff_media_type(head: bytes) -> Optional[str]:
+    """Detects common preview formats from their leading magic bytes."""
+    if head.startswith(b'\xff\xd8\xff'): return "image/jpeg"
+    if head.startswith(b'\x89PNG\r\n\x1a\n'): return "image/png"
+    if head.startswith((b'GIF87a', b'GIF89a')): return "image/gif"
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP': return "image/webp"
+    if head[4:8] == b'ftyp': return "video/quicktime" if head[8:10] == b'qt' else "video/mp4"
+    return None
+
+def parse_uuid(value: str) -> Optional[uuid.UUID]:
+    """Parses an item id from a deep link or callback, or None if it is malformed."""
+    try:
+        return uuid.UUID(value)
+    except ValueError:
+        return None
+
+SEND_BY_KIND = {'photo': bot.send_photo, 'video': bot.send_video, 'doc': bot.send_document}
+DOWNLOAD_CAPTIONS = {'photo': "📸", 'video': "🎥", 'doc': "📄"}
+
+def get_pool() -> asyncpg.Pool:
+    """Returns the shared Postgres pool created in `lifespan`."""
+    return app.state.pool
+
+def get_http() -> aiohttp.ClientSession:
+    """Returns the shared keep-alive HTTP session created in `lifespan`."""
+    return app.state.http
+
+# Dropped or refused connections (e.g. a pooler restart) that a second attempt can
+# survive. Only read-only queries go through retry_db, so a retry never repeats a write.
+DB_RETRYABLE = (ConnectionError, asyncpg.InterfaceError, asyncpg.PostgresConnectionError, asyncpg.CannotConnectNowError)
+
+async def retry_db(query, retries=3):
+    """Awaits `query()`, retrying connection failures with jittered exponential backoff."""
+    for attempt in range(retries):
+        try:
+            return await query()
+        except DB_RETRYABLE:
+            if attempt == retries - 1: raise
+            await asyncio.sleep(0.1 * 2 ** attempt + random.random() * 0.05)
+
+# Telegram file paths stay valid for about an hour; keep them a bit less than that
+FILE_PATH_TTL = 3300
+FILE_PATH_CACHE_SIZE = 10000
+_file_path_cache = {}  # file_id -> (file_path, expires_at)
+_file_path_inflight = {}  # file_id -> Task fetching its path
+
+async def _fetch_file_path(file_id: str) -> str:
+    file_info = await bot.get_file(file_id)
+    if len(_file_path_cache) >= FILE_PATH_CACHE_SIZE:
+        _file_path_cache.pop(next(iter(_file_path_cache)))
+    _file_path_cache[file_id] = (file_info.file_path, time.monotonic() + FILE_PATH_TTL)
+    return file_info.file_path
+
+async def resolve_file_path(file_id: str) -> str:
+    """Returns the Telegram CDN path for a file, cached to skip repeated getFile calls.
+
+    Concurrent misses for the same file_id share one getFile request.
+    """
+    cached = _file_path_cache.pop(file_id, None)
+    if cached and cached[1] > time.monotonic():
+        # Re-inserting moves the entry to the end, so eviction drops the least recently used path
+        _file_path_cache[file_id] = cached
+        return cached[0]
+
+    task = _file_path_inflight.get(file_id)
+    if task is None:
+        task = asyncio.create_task(_fetch_file_path(file_id))
+        _file_path_inflight[file_id] = task
+        task.add_done_callback(lambda _: _file_path_inflight.pop(file_id, None))
+    # Shielded so one cancelled preview request does not cancel the fetch for the others
+    return await asyncio.shield(task)
+
+# Users rarely change their username, so a new user is upserted right away (items
+# reference users(id), so the row must exist before their first save or upload),
+# while username changes and repeat sightings are queued and written in batches
+USER_SEEN_TTL = 3600
+USER_FLUSH_INTERVAL = 10
+USER_SEEN_SIZE = 50000
+UPSERT_USER_SQL = "INSERT INTO users (id, username) VALUES ($1, $2) ON CONFLICT (id) DO UPDATE SET username = EXCLUDED.username"
+_seen_users = {}  # user_id -> (username, seen_at)
+_pending_users = {}  # user_id -> username
+
+def username_of(user) -> str:
+    # Logic to fix missing usernames
+    return user.username or user.first_name or "User"
+
+async def register_user(user_id: int, username: str):
+    now = time.monotonic()
+    seen = _seen_users.get(user_id)
+    if seen and seen[0] == username and now - seen[1] < USER_SEEN_TTL: return
+    if seen is None:
+        await retry_db(lambda: get_pool().execute(UPSERT_USER_SQL, user_id, username))
+        invalidate_user(user_id)
+        _pending_users.pop(user_id, None)
+        if ADMIN_ID is None and username == ADMIN_USERNAME: await resolve_admin_id(force=True)
+    # Re-inserting keeps the dict ordered by last upsert, so eviction drops the stalest user
+    _seen_users.pop(user_id, None)
+    if len(_seen_users) >= USER_SEEN_SIZE:
+        _seen_users.pop(next(iter(_seen_users)))
+    _seen_users[user_id] = (username, now)
+    if seen is not None: _pending_users[user_id] = username
+
+async def flush_users():
+    if not _pending_users: return
+    batch = list(_pending_users.items())
+    _pending_users.clear()
     try:
-        res = supabase.table("users").select("username, is_blocked").eq("id", user_id).single().execute()
-        if res.data:
-            # Admin cannot be blocked
-            if res.data['username'] == ADMIN_USERNAME: return
-            if res.data.get('is_blocked', False):
-                raise HTTPException(status_code=403, detail="USER_BLOCKED")
-    except HTTPException:
+        await get_pool().executemany(UPSERT_USER_SQL, batch)
+        for user_id, _ in batch: invalidate_user(user_id)
+    except Exception:
+        # Forget these users so their next message queues them again
+        for user_id, _ in batch: _seen_users.pop(user_id, None)
         raise
-    except:
-        pass
+    if ADMIN_ID is None and any(username == ADMIN_USERNAME for _, username in batch):
+        await resolve_admin_id(force=True)
 
-def get_folder_tree_text(user_id, folder_id, indent=0):
-    items = supabase.table("items").select("*").eq("user_id", user_id).eq("parent_id", folder_id).execute().data
-    items.sort(key=lambda x: (x['type'] != 'folder', x['name']))
-    
-    text = ""
-    for i, item in enumerate(items, 1):
-        prefix = "    " * indent
+async def flush_users_periodically():
+    while True:
+        await asyncio.sleep(USER_FLUSH_INTERVAL)
+        try:
+            await flush_users()
+        except Exception:
+            log.exception("Failed to flush users")
+
+# /api/files responses are reused for FILES_CACHE_TTL seconds; every write path
+# drops the owner's entries through invalidate_files(). Invalidation cannot reach
+# other processes, so the cache is off when running several workers.
+FILES_CACHE_TTL = 10 if WEB_WORKERS == 1 else 0
+FILES_CACHE_USERS = 10000
+FILES_CACHE_PER_USER = 50
+_files_cache = {}  # user_id -> {query key: (expires_at, JSON body)}
+
+def get_cached_files(user_id: int, key: tuple):
+    entries = _files_cache.get(user_id)
+    cached = entries.get(key) if entries else None
+    if cached is None: return None
+    if cached[0] > time.monotonic(): return cached[1]
+    del entries[key]
+    return None
+
+def cache_files(user_id: int, key: tuple, body: bytes):
+    if not FILES_CACHE_TTL: return
+    if user_id not in _files_cache and len(_files_cache) >= FILES_CACHE_USERS:
+        _files_cache.pop(next(iter(_files_cache)))
+    entries = _files_cache.setdefault(user_id, {})
+    now = time.monotonic()
+    # Paging through a large library adds a key per page; expired pages are dropped
+    # first, then the oldest ones
+    for stale in [k for k, (expires_at, _) in entries.items() if expires_at <= now]:
+        del entries[stale]
+    entries.pop(key, None)
+    if len(entries) >= FILES_CACHE_PER_USER:
+        entries.pop(next(iter(entries)))
+    entries[key] = (now + FILES_CACHE_TTL, body)
+
+def invalidate_files(user_id):
+    _files_cache.pop(user_id, None)
+
+# Per-user token bucket for uploads and /api/download: up to USER_RATE_BURST requests
+# at once (a full album fits), refilled at USER_RATE_PER_SEC
+USER_RATE_PER_SEC = 1
+USER_RATE_BURST = 20
+USER_RATE_RETRY_AFTER = 1
+USER_RATE_BUCKETS = 50000
+_rate_buckets = {}  # user_id -> (tokens, updated_at)
+
+def take_token(user_id: int) -> bool:
+    now = time.monotonic()
+    bucket = _rate_buckets.pop(user_id, None)
+    if bucket is None and len(_rate_buckets) >= USER_RATE_BUCKETS:
+        _rate_buckets.pop(next(iter(_rate_buckets)))
+    tokens, updated_at = bucket or (USER_RATE_BURST, now)
+    tokens = min(USER_RATE_BURST, tokens + (now - updated_at) * USER_RATE_PER_SEC)
+    if tokens < 1:
+        _rate_buckets[user_id] = (tokens, now)
+        return False
+    _rate_buckets[user_id] = (tokens - 1, now)
+    return True
+
+_background_tasks = set()
+
+def spawn(coro):
+    """Starts a fire-and-forget task, keeping a reference so it is not garbage-collected."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# Telegram delivers an album as one message per file; they are collected for
+# ALBUM_FLUSH_DELAY seconds and written with a single COPY
+ALBUM_FLUSH_DELAY = 0.5
+ITEM_COLUMNS = ['user_id', 'name', 'type', 'file_id', 'size', 'parent_id']
+_pending_albums = {}  # media_group_id -> (first message, [item records])
+
+def queue_album_file(message: Message, record: tuple):
+    pending = _pending_albums.get(message.media_group_id)
+    if pending:
+        pending[1].append(record)
+        return
+    _pending_albums[message.media_group_id] = (message, [record])
+    spawn(flush_album(message.media_group_id))
+
+async def flush_album(media_group_id: str):
+    await asyncio.sleep(ALBUM_FLUSH_DELAY)
+    message, records = _pending_albums.pop(media_group_id)
+    try:
+        await get_pool().copy_records_to_table('items', records=records, columns=ITEM_COLUMNS)
+        invalidate_files(records[0][0])
+        await message.answer(f"💾 Сохранено файлов: {len(records)}")
+    except Exception:
+        log.exception("Failed to save album %s", media_group_id)
+        await message.answer("Ошибка сохранения.")
+
+# username / is_blocked lookups for the block and admin checks are reused for
+# USER_CACHE_TTL seconds; admin actions drop the target's entry right away
+USER_CACHE_TTL = 30
+USER_CACHE_SIZE = 50000
+_user_cache = {}  # user_id -> (expires_at, row or None)
+
+async def get_user_row(user_id: int):
+    cached = _user_cache.get(user_id)
+    if cached and cached[0] > time.monotonic(): return cached[1]
+    row = await retry_db(lambda: get_pool().fetchrow("SELECT username, is_blocked FROM users WHERE id = $1", user_id))
+    if user_id not in _user_cache and len(_user_cache) >= USER_CACHE_SIZE:
+        _user_cache.pop(next(iter(_user_cache)))
+    _user_cache[user_id] = (time.monotonic() + USER_CACHE_TTL, row)
+    return row
+
+def invalidate_user(user_id):
+    _user_cache.pop(user_id, None)
+
+# While the admin's row does not exist yet (fresh database, no /start), the lookup
+# is repeated at most every ADMIN_RESOLVE_INTERVAL seconds, and right after the
+# admin's username is upserted. users.username falls back to first_name, so a
+# matching row is only trusted once Telegram confirms it is the admin's @username.
+ADMIN_RESOLVE_INTERVAL = 30
+ADMIN_CANDIDATES = 20
+_admin_resolved_at = None
+
+async def resolve_admin_id(force=False):
+    global ADMIN_ID, _admin_resolved_at
+    if ADMIN_ID is not None: return ADMIN_ID
+    now = time.monotonic()
+    if not force and _admin_resolved_at is not None and now - _admin_resolved_at < ADMIN_RESOLVE_INTERVAL: return None
+    _admin_resolved_at = now
+    rows = await get_pool().fetch("SELECT id FROM users WHERE username = $1 LIMIT $2", ADMIN_USERNAME, ADMIN_CANDIDATES)
+    for row in rows:
+        try:
+            chat = await bot.get_chat(row['id'])
+        except TelegramAPIError:
+            continue
+        if (chat.username or "").lower() == ADMIN_USERNAME.lower():
+            ADMIN_ID = row['id']
+            break
+    return ADMIN_ID
+
+# Errors meaning Postgres is unreachable or overloaded, as opposed to a bad query.
+# They surface as 503 + Retry-After so clients back off instead of retrying at once.
+DB_UNAVAILABLE = (
+    OSError, asyncio.TimeoutError, asyncpg.InterfaceError, asyncpg.PostgresConnectionError,
+    asyncpg.TooManyConnectionsError, asyncpg.CannotConnectNowError,
+)
+DB_RETRY_AFTER = 5
+DB_UNAVAILABLE_TEXT = "⚠️ Сервис временно недоступен, попробуйте позже."
+
+def db_unavailable() -> HTTPException:
+    return HTTPException(status_code=503, detail="Database unavailable", headers={"Retry-After": str(DB_RETRY_AFTER)})
+
+async def check_is_blocked(user_id: int):
+    # Admin cannot be blocked
+    if user_id == ADMIN_ID: return
+    try:
+        user = await get_user_row(user_id)
+    except DB_UNAVAILABLE:
+        raise db_unavailable()
+    if user and user['is_blocked']:
+        raise HTTPException(status_code=403, detail="USER_BLOCKED")
+
+# Every descendant of a folder, folders first then by name, so a shared folder is
+# read without touching the rest of its owner's library. Only the folder owner's
+# items are followed: parent_id is client-supplied, so other users' items may
+# point into someone else's folder.
+SUBTREE_SQL = """
+WITH RECURSIVE subtree AS (
+    SELECT i.id, i.user_id, i.name, i.type, i.file_id, i.size, i.parent_id
+    FROM items f JOIN items i ON i.parent_id = f.id AND i.user_id = f.user_id
+    WHERE f.id = $1
+    UNION ALL
+    SELECT i.id, i.user_id, i.name, i.type, i.file_id, i.size, i.parent_id
+    FROM items i JOIN subtree s ON i.parent_id = s.id AND i.user_id = s.user_id
+)
+SELECT id, name, type, file_id, size, parent_id FROM subtree ORDER BY type <> 'folder', name
+"""
+
+async def load_subtree(folder_id) -> dict:
+    """Fetches a folder's descendants in one query, grouped by parent_id in display order."""
+    tree = defaultdict(list)
+    for item in await retry_db(lambda: get_pool().fetch(SUBTREE_SQL, folder_id)):
+        tree[item['parent_id']].append(item)
+    return tree
+
+_INDENTS = ["    " * n for n in range(16)]
+
+def get_folder_tree_text(tree, folder_id, indent=0):
+    """Renders a folder's contents as a numbered outline.
+
+    Walks the tree with an explicit stack and writes into one buffer, so deep
+    trees neither hit the recursion limit nor rebuild the string at every level.
+    """
+    buf = io.StringIO()
+    stack = [(indent, enumerate(tree.get(folder_id, ()), 1))]
+    while stack:
+        depth, children = stack[-1]
+        entry = next(children, None)
+        if entry is None:
+            stack.pop()
+            continue
+        i, item = entry
+        prefix = _INDENTS[depth] if depth < len(_INDENTS) else "    " * depth
         if item['type'] == 'folder':
-            text += f"{prefix}{i}. Папка «{item['name']}»:\n"
-            text += get_folder_tree_text(user_id, item['id'], indent + 1)
+            buf.write(f"{prefix}{i}. Папка «{item['name']}»:\n")
+            stack.append((depth + 1, enumerate(tree.get(item['id'], ()), 1)))
         else:
-            text += f"{prefix}{i}. {item['name']}\n"
-    return text
+            buf.write(f"{prefix}{i}. {item['name']}\n")
+    return buf.getvalue()
+
+# Walks the source subtree (the owner's items only, like SUBTREE_SQL), gives every
+# node a fresh id and re-links children to their copied parents, all in one
+# statement. MATERIALIZED pins each node's new id so both sides of the self-join
+# see the same value.
+COPY_SUBTREE_SQL = """
+WITH RECURSIVE subtree AS (
+    SELECT id, user_id, name, type, file_id, size, parent_id FROM items WHERE id = $1
+    UNION ALL
+    SELECT i.id, i.user_id, i.name, i.type, i.file_id, i.size, i.parent_id
+    FROM items i JOIN subtree s ON i.parent_id = s.id AND i.user_id = s.user_id
+), mapped AS MATERIALIZED (
+    SELECT *, gen_random_uuid() AS new_id FROM subtree
+)
+INSERT INTO items (id, user_id, name, type, file_id, size, parent_id)
+SELECT m.new_id, $2, m.name, m.type, m.file_id, m.size, COALESCE(p.new_id, $3)
+FROM mapped m LEFT JOIN mapped p ON m.parent_id = p.id
+"""
 
 async def copy_folder_recursive(source_folder_id, target_user_id, target_parent_id=None):
     """Recursively copies a folder to another user."""
-    folder_res = supabase.table("items").select("*").eq("id", source_folder_id).single().execute()
-    if not folder_res.data: return
-    
-    source_folder = folder_res.data
-    new_folder_data = {
-        "user_id": target_user_id,
-        "name": source_folder['name'],
-        "type": "folder",
-        "parent_id": target_parent_id
-    }
-    new_folder = supabase.table("items").insert(new_folder_data).execute().data[0]
-    
-    items = supabase.table("items").select("*").eq("parent_id", source_folder_id).execute().data
-    
-    for item in items:
-        if item['type'] == 'folder':
-            await copy_folder_recursive(item['id'], target_user_id, new_folder['id'])
-        else:
-            new_file = {
-                "user_id": target_user_id,
-                "name": item['name'],
-                "type": "file",
-                "file_id": item['file_id'],
-                "size": item['size'],
-                "parent_id": new_folder['id']
-            }
-            supabase.table("items").insert(new_file).execute()
-
-async def send_folder_contents(chat_id, folder_id):
-    """Recursively sends files to a chat."""
-    items = supabase.table("items").select("*").eq("parent_id", folder_id).execute().data
-    items.sort(key=lambda x: (x['type'] != 'folder', x['name']))
-
-    for item in items:
+    await get_pool().execute(COPY_SUBTREE_SQL, source_folder_id, target_user_id, target_parent_id)
+
+# Telegram allows a bot about 30 messages per second overall; sends are spaced to
+# stay under that. A single chat tolerates short bursts above its ~1/s average, so
+# sends into one chat only get a short gap and a RetryAfter does the backing off,
+# pausing only the chat it came from so one busy chat does not stall the others.
+# Each worker process paces itself, so the overall budget is split between them.
+TG_SEND_RATE = 30 / WEB_WORKERS
+TG_CHAT_INTERVAL = 0.2
+TG_CHAT_PACING_SIZE = 10000
+# Caps sends in flight across all chats, so slow uploads cannot pile up behind the pacing
+TG_SEND_CONCURRENCY = max(1, 25 // WEB_WORKERS)
+_send_slots = asyncio.Semaphore(TG_SEND_CONCURRENCY)
+_next_send_at = 0.0
+_next_chat_send_at = {}  # chat_id -> earliest time of its next send
+
+async def throttle_send(chat_id):
+    global _next_send_at
+    now = time.monotonic()
+    chat_at = max(now, _next_chat_send_at.pop(chat_id, 0.0))
+    if len(_next_chat_send_at) >= TG_CHAT_PACING_SIZE:
+        _next_chat_send_at.pop(next(iter(_next_chat_send_at)))
+    _next_chat_send_at[chat_id] = chat_at + TG_CHAT_INTERVAL
+    if chat_at > now: await asyncio.sleep(chat_at - now)
+
+    # The overall slot is only reserved once the chat's turn has come
+    now = time.monotonic()
+    delay = _next_send_at - now
+    _next_send_at = max(now, _next_send_at) + 1 / TG_SEND_RATE
+    if delay > 0: await asyncio.sleep(delay)
+
+def pause_sends(chat_id, seconds: float):
+    _next_chat_send_at[chat_id] = max(_next_chat_send_at.get(chat_id, 0.0), time.monotonic() + seconds)
+
+async def send_with_retry(chat_id, send, retries=3):
+    """Paces and runs one Telegram send, where `send` returns the request coroutine.
+
+    A RetryAfter pauses the chat and the send is tried again; the last one is re-raised.
+    """
+    for attempt in range(retries):
+        await throttle_send(chat_id)
+        try:
+            async with _send_slots:
+                return await send()
+        except TelegramRetryAfter as e:
+            pause_sends(chat_id, e.retry_after)
+            if attempt == retries - 1: raise
+
+async def send_file(chat_id, file_id, name, caption=None, retries=3):
+    send = SEND_BY_KIND[file_kind(name)]
+    return await send_with_retry(chat_id, lambda: send(chat_id, file_id, caption=caption or name), retries)
+
+async def send_folder_contents(chat_id, tree, folder_id):
+    """Recursively sends files to a chat.
+
+    Items go out one at a time in listing order (subfolders first, each header
+    followed by its contents), so the chat shows them in the order of the tree;
+    throttle_send() spaces them within Telegram's per-chat limit.
+    """
+    for item in tree.get(folder_id, ()):
         if item['type'] == 'folder':
-            await bot.send_message(chat_id, f"📂 <b>{item['name']}</b>", parse_mode="HTML")
-            await send_folder_contents(chat_id, item['id'])
-        else:
-            try:
-                if item['name'].lower().endswith(('.jpg', '.jpeg', '.png')):
-                    await bot.send_photo(chat_id, item['file_id'], caption=item['name'])
-                elif item['name'].lower().endswith(('.mp4', '.mov')):
-                    await bot.send_video(chat_id, item['file_id'], caption=item['name'])
-                else:
-                    await bot.send_document(chat_id, item['file_id'], caption=item['name'])
-                await asyncio.sleep(0.3) # Anti-flood delay
-            except:
-                pass
+            await send_with_retry(chat_id, lambda: bot.send_message(chat_id, f"📂 <b>{item['name']}</b>", parse_mode="HTML"))
+            await send_folder_contents(chat_id, tree, item['id'])
+            continue
+        try:
+            await send_file(chat_id, item['file_id'], item['name'])
+        except Exception:
+            log.warning("Failed to send %s to chat %s", item['id'], chat_id, exc_info=True)
 
 
 # --- PAYMENT LOGIC (STARS) ---
@@ -121,56 +486,55 @@ async def successful_payment(message: Message):
 
 # --- BOT HANDLERS ---
 
+# Built once; the /start greeting reuses it
+_WELCOME_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Открыть Tg Cloud", web_app={"url": "https://tg-cloud-frontend.vercel.app"})]
+])
+
 @dp.message(CommandStart())
 async def command_start(message: Message, command: CommandObject):
     user_id = message.from_user.id
-    
-    # Logic to fix missing usernames
-    username = message.from_user.username
-    if not username:
-        username = message.from_user.first_name or "User"
-    
-    try:
-        supabase.table("users").upsert({"id": user_id, "username": username}).execute()
-    except:
-        pass
+    try: await register_user(user_id, username_of(message.from_user))
+    except DB_UNAVAILABLE:
+        await message.answer(DB_UNAVAILABLE_TEXT)
+        return
 
     args = command.args
     
     # 1. FILE SHARING
     if args and args.startswith("file_"):
-        requested_uuid = args.replace("file_", "")
+        requested_uuid = parse_uuid(args.removeprefix("file_"))
+        if requested_uuid is None:
+            await message.answer("Некорректная ссылка.")
+            return
         try:
-            res = supabase.table("items").select("*").eq("id", requested_uuid).limit(1).execute()
-            if res.data:
-                file_data = res.data[0]
+            file_data = await get_pool().fetchrow("SELECT name, type, file_id FROM items WHERE id = $1", requested_uuid)
+            if file_data:
                 await message.answer(f"📂 Вам отправили файл: <b>{file_data['name']}</b>", parse_mode="HTML")
                 if file_data['type'] == 'folder':
                      await message.answer("Это папка. Используйте ссылку для папки.")
                      return
                 try:
-                    f_id = file_data['file_id']
-                    name = file_data['name'].lower()
-                    if name.endswith(('.jpg', '.jpeg', '.png')):
-                        await message.answer_photo(f_id)
-                    elif name.endswith(('.mp4', '.mov')):
-                        await message.answer_video(f_id)
-                    else:
-                        await message.answer_document(f_id)
-                except:
+                    send = SEND_BY_KIND[file_kind(file_data['name'])]
+                    await send_with_retry(message.chat.id, lambda: send(message.chat.id, file_data['file_id']))
+                except Exception:
                     await message.answer("Ошибка отправки.")
             else:
                 await message.answer("Файл не найден.")
-        except:
+        except DB_UNAVAILABLE:
+            await message.answer(DB_UNAVAILABLE_TEXT)
+        except Exception:
              await message.answer("Некорректная ссылка.")
     
     # 2. FOLDER SHARING
     elif args and args.startswith("folder_"):
-        folder_uuid = args.replace("folder_", "")
+        folder_uuid = parse_uuid(args.removeprefix("folder_"))
+        if folder_uuid is None:
+            await message.answer("Некорректная ссылка на папку.")
+            return
         try:
-            res = supabase.table("items").select("*").eq("id", folder_uuid).eq("type", "folder").limit(1).execute()
-            if res.data:
-                folder_data = res.data[0]
+            folder_data = await get_pool().fetchrow("SELECT name FROM items WHERE id = $1 AND type = 'folder'", folder_uuid)
+            if folder_data:
                 kb = InlineKeyboardMarkup(inline_keyboard=[
                     [InlineKeyboardButton(text="☁️ Сохранить в облако", callback_data=f"save_{folder_uuid}")],
                     [InlineKeyboardButton(text="📥 Выгрузить в чат", callback_data=f"send_{folder_uuid}")],
@@ -183,50 +547,71 @@ async def command_start(message: Message, command: CommandObject):
                 )
             else:
                 await message.answer("Папка не найдена или удалена.")
-        except:
+        except DB_UNAVAILABLE:
+            await message.answer(DB_UNAVAILABLE_TEXT)
+        except Exception:
             await message.answer("Некорректная ссылка на папку.")
             
     else:
-        await message.answer("Привет! Отправь мне файлы для сохранения или открой Mini App.", 
-                             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                                 [InlineKeyboardButton(text="Открыть Tg Cloud", web_app={"url": "https://tg-cloud-frontend.vercel.app"})] 
-                             ]))
+        await message.answer("Привет! Отправь мне файлы для сохранения или открой Mini App.", reply_markup=_WELCOME_KB)
 
 @dp.callback_query(F.data.startswith("save_"))
 async def cb_save_folder(callback: CallbackQuery):
-    folder_id = callback.data.split("_")[1]
+    folder_id = parse_uuid(callback.data.removeprefix("save_"))
+    if folder_id is None:
+        await callback.answer("Некорректная ссылка.", show_alert=True)
+        return
     user_id = callback.from_user.id
     await callback.answer("Начинаю копирование...")
     try:
         await copy_folder_recursive(folder_id, user_id, None)
+        invalidate_files(user_id)
         await callback.message.answer("✅ Папка успешно сохранена в ваше облако!")
-    except:
+    except DB_UNAVAILABLE:
+        await callback.message.answer(DB_UNAVAILABLE_TEXT)
+    except Exception:
         await callback.message.answer("Ошибка при копировании.")
 
 @dp.callback_query(F.data.startswith("send_"))
 async def cb_send_folder(callback: CallbackQuery):
-    folder_id = callback.data.split("_")[1]
+    folder_id = parse_uuid(callback.data.removeprefix("send_"))
+    if folder_id is None:
+        await callback.answer("Некорректная ссылка.", show_alert=True)
+        return
     await callback.answer("Начинаю отправку файлов...")
     await callback.message.answer("⏳ Выгрузка файлов началась...")
     try:
-        await send_folder_contents(callback.from_user.id, folder_id)
+        # A missing folder simply has an empty subtree, so no existence lookup is needed
+        await send_folder_contents(callback.from_user.id, await load_subtree(folder_id), folder_id)
         await callback.message.answer("✅ Выгрузка завершена.")
-    except:
+    except DB_UNAVAILABLE:
+        await callback.message.answer(DB_UNAVAILABLE_TEXT)
+    except Exception:
         await callback.message.answer("Ошибка при отправке.")
 
 @dp.callback_query(F.data.startswith("view_"))
 async def cb_view_folder(callback: CallbackQuery):
-    folder_id = callback.data.split("_")[1]
+    folder_id = parse_uuid(callback.data.removeprefix("view_"))
+    if folder_id is None:
+        await callback.answer("Некорректная ссылка.", show_alert=True)
+        return
     await callback.answer()
     
-    # Get folder info for the owner's user_id
-    folder_res = supabase.table("items").select("user_id, name").eq("id", folder_id).single().execute()
-    if not folder_res.data:
+    # The name lookup and the subtree fetch are independent, so both round-trips overlap
+    try:
+        folder, tree = await asyncio.gather(
+            get_pool().fetchrow("SELECT name FROM items WHERE id = $1", folder_id),
+            load_subtree(folder_id),
+        )
+    except DB_UNAVAILABLE:
+        await callback.message.answer(DB_UNAVAILABLE_TEXT)
+        return
+    if not folder:
         await callback.message.answer("Папка не найдена.")
         return
-        
-    tree_text = get_folder_tree_text(folder_res.data['user_id'], folder_id, indent=0)
-    msg_text = f"Папка «{folder_res.data['name']}»:\n\n{tree_text}" if tree_text else f"Папка «{folder_res.data['name']}» пуста."
+
+    tree_text = get_folder_tree_text(tree, folder_id, indent=0)
+    msg_text = f"Папка «{folder['name']}»:\n\n{tree_text}" if tree_text else f"Папка «{folder['name']}» пуста."
     
     if len(msg_text) > 4000: msg_text = msg_text[:4000] + "\n..."
     await callback.message.answer(msg_text)
@@ -234,284 +619,513 @@ async def cb_view_folder(callback: CallbackQuery):
 @dp.message(F.document | F.photo | F.video | F.audio)
 async def handle_files(message: Message):
     user_id = message.from_user.id
+    try: await register_user(user_id, username_of(message.from_user))
+    except DB_UNAVAILABLE:
+        await message.answer(DB_UNAVAILABLE_TEXT)
+        return
     
     # Check for block
-    try: check_is_blocked(user_id)
-    except: await message.answer("⛔ Ваш аккаунт заблокирован администратором."); return
+    try: await check_is_blocked(user_id)
+    except HTTPException as e:
+        if e.status_code == 503: await message.answer(DB_UNAVAILABLE_TEXT); return
+        await message.answer("⛔ Ваш аккаунт заблокирован администратором."); return
+    if not take_token(user_id):
+        await message.answer("⏳ Слишком много файлов подряд, подождите немного."); return
 
     file_id = None
     file_name = "Без названия"
     file_size = 0
 
-    if message.document:
-        file_id = message.document.file_id
-        file_name = message.document.file_name or "doc"
-        file_size = message.document.file_size
+    if doc := message.document:
+        file_id, file_name, file_size = doc.file_id, doc.file_name or "doc", doc.file_size
     elif message.photo:
-        file_id = message.photo[-1].file_id
-        file_name = f"img_{message.date}.jpg"
-        file_size = message.photo[-1].file_size
-    elif message.video:
-        file_id = message.video.file_id
-        file_name = message.video.file_name or "video.mp4"
-        file_size = message.video.file_size
+        photo = message.photo[-1]
+        file_id, file_name, file_size = photo.file_id, f"img_{message.date}.jpg", photo.file_size
+    elif video := message.video:
+        file_id, file_name, file_size = video.file_id, video.file_name or "video.mp4", video.file_size
 
     if file_id:
-        try:
-            new_file = {
-                "user_id": user_id,
-                "name": file_name,
-                "type": "file",
-                "file_id": file_id,
-                "size": file_size,
-                "parent_id": None 
-            }
-            supabase.table("items").insert(new_file).execute()
-            await message.answer(f"💾 Сохранено: {file_name}")
-        except Exception as e:
-            print(e)
+        if message.media_group_id:
+            queue_album_file(message, (user_id, file_name, 'file', file_id, file_size, None))
+            return
+        # The insert and the confirmation are independent, so both round-trips overlap
+        saved, _ = await asyncio.gather(
+            get_pool().execute(
+                "INSERT INTO items (user_id, name, type, file_id, size, parent_id) VALUES ($1, $2, 'file', $3, $4, NULL)",
+                user_id, file_name, file_id, file_size
+            ),
+            message.answer(f"💾 Сохранено: {file_name}"),
+            return_exceptions=True,
+        )
+        if isinstance(saved, Exception):
+            log.error("Failed to save file for user %s", user_id, exc_info=saved)
             await message.answer("Ошибка сохранения.")
+        else:
+            invalidate_files(user_id)
 
 # --- API INITIALIZATION ---
 
+def start_log_listener() -> logging.handlers.QueueListener:
+    """Routes app logs through a queue so handlers never write to stdout on the event loop."""
+    log_queue = queue.Queue(-1)
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    listener.start()
+    return listener
+
+async def register_webhook():
+    allowed_updates = dp.resolve_used_update_types()
+    # The URL carries a fingerprint of the secret and update types: workers that find
+    # it already registered skip setWebhook, while a rotated secret is still re-registered
+    fingerprint = hashlib.sha256(f"{WEBHOOK_SECRET}:{','.join(sorted(allowed_updates))}".encode()).hexdigest()[:12]
+    url = f"{PUBLIC_URL}/tg/webhook?v={fingerprint}"
+    if (await bot.get_webhook_info()).url == url: return
+    await bot.set_webhook(url, secret_token=WEBHOOK_SECRET, allowed_updates=allowed_updates)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    asyncio.create_task(dp.start_polling(bot))
+    log_listener = start_log_listener()
+    # statement_cache_size=0 keeps the pool compatible with Supavisor/pgbouncer transaction mode
+    app.state.pool = await asyncpg.create_pool(
+        dsn=PG_DSN,
+        min_size=10,
+        max_size=50,
+        max_inactive_connection_lifetime=300,
+        command_timeout=60,
+        statement_cache_size=0,
+    )
+    app.state.http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, limit_per_host=30, ttl_dns_cache=300, keepalive_timeout=60)
+    )
+    if WEB_WORKERS > 1 and not os.getenv("WEBHOOK_SECRET"):
+        raise RuntimeError("WEBHOOK_SECRET is required with WEB_WORKERS > 1: every worker would generate its own")
+    if PUBLIC_URL:
+        await register_webhook()
+    elif WEB_WORKERS > 1:
+        raise RuntimeError("PUBLIC_URL is required with WEB_WORKERS > 1: every worker would poll Telegram")
+    else:
+        # Local runs without a public URL fall back to long polling
+        asyncio.create_task(dp.start_polling(bot))
+    if await resolve_admin_id() is None:
+        log.warning("Admin %s not found yet; admin endpoints stay disabled until they send /start", ADMIN_USERNAME)
+    users_flusher = asyncio.create_task(flush_users_periodically())
     yield
+    users_flusher.cancel()
+    await flush_users()
     await bot.session.close()
+    await app.state.pool.close()
+    await app.state.http.close()
+    log_listener.stop()
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=FRONTEND_ORIGINS,
+    allow_credentials=False,
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type"],
+    # Browsers reuse a preflight result for a day instead of sending OPTIONS before each POST
+    max_age=86400,
 )
 
+async def db_unavailable_handler(request: Request, exc: Exception):
+    e = db_unavailable()
+    return ORJSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers)
+
+for exc_type in DB_UNAVAILABLE: app.add_exception_handler(exc_type, db_unavailable_handler)
+
+# Added last so it is the outermost middleware and compresses every JSON listing
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # --- REQUEST MODELS ---
 
-class AdminRequest(BaseModel):
+class RequestModel(BaseModel):
+    # Request bodies are never modified after validation
+    model_config = ConfigDict(frozen=True)
+
+class AdminRequest(RequestModel):
     admin_id: int
     target_user_id: Optional[int] = None
 
-class DeleteAllRequest(BaseModel):
+class DeleteAllRequest(RequestModel):
     user_id: int
 
-class FolderRequest(BaseModel):
+class FolderRequest(RequestModel):
     user_id: int
     name: str
     parent_id: Optional[str] = None
 
-class RenameRequest(BaseModel):
+class RenameRequest(RequestModel):
     item_id: str
     new_name: str
 
-class ItemRequest(BaseModel):
+class ItemRequest(RequestModel):
     item_id: str
 
-class DownloadRequest(BaseModel):
+class DownloadRequest(RequestModel):
     user_id: int
     file_id: str
     file_name: str
     recipient_id: Optional[int] = None
 
-class MoveRequest(BaseModel):
+class MoveRequest(RequestModel):
     file_id: str
     folder_id: Optional[str]
 
-class InvoiceRequest(BaseModel):
+class InvoiceRequest(RequestModel):
     amount: int
     title: str = "Поддержка автора"
     description: str = "Донат на развитие проекта"
 
+# --- API ENDPOINTS: TELEGRAM ---
+
+@app.post("/tg/webhook")
+async def telegram_webhook(request: Request, x_telegram_bot_api_secret_token: Optional[str] = Header(None)):
+    if not secrets.compare_digest((x_telegram_bot_api_secret_token or "").encode(), WEBHOOK_SECRET.encode()):
+        raise HTTPException(403, "Access Denied")
+    update = Update.model_validate(await request.json(), context={"bot": bot})
+    # Answer Telegram right away; long handlers (folder copy/send) keep running in the background
+    spawn(dp.feed_update(bot, update))
+    return {"ok": True}
+
 # --- API ENDPOINTS: ADMIN ---
 
 @app.post("/api/admin/users")
-async def get_all_users(req: AdminRequest):
-    # Check if user is admin
-    admin = supabase.table("users").select("username").eq("id", req.admin_id).single().execute()
-    if not admin.data or admin.data['username'] != ADMIN_USERNAME:
+async def get_all_users(req: AdminRequest, pool: asyncpg.Pool = Depends(get_pool)):
+    if req.admin_id != await resolve_admin_id():
         raise HTTPException(403, "Access Denied")
     
-    users = supabase.table("users").select("*").order("id", desc=True).execute().data
+    users = [dict(u) for u in await retry_db(lambda: pool.fetch("SELECT * FROM users ORDER BY id DESC"))]
     # Admin is always on top
-    users.sort(key=lambda u: u['username'] != ADMIN_USERNAME)
+    users.sort(key=lambda u: u['id'] != ADMIN_ID)
     return users
 
 @app.post("/api/admin/block")
-async def toggle_block_user(req: AdminRequest):
-    admin = supabase.table("users").select("username").eq("id", req.admin_id).single().execute()
-    if not admin.data or admin.data['username'] != ADMIN_USERNAME:
+async def toggle_block_user(req: AdminRequest, pool: asyncpg.Pool = Depends(get_pool)):
+    if req.admin_id != await resolve_admin_id():
         raise HTTPException(403, "Access Denied")
     
     if req.target_user_id == req.admin_id: return {"status": "error"} # Cannot block self
 
-    curr = supabase.table("users").select("is_blocked").eq("id", req.target_user_id).single().execute()
-    new_status = not curr.data.get('is_blocked', False)
-    
-    supabase.table("users").update({"is_blocked": new_status}).eq("id", req.target_user_id).execute()
+    new_status = await pool.fetchval(
+        "UPDATE users SET is_blocked = NOT COALESCE(is_blocked, FALSE) WHERE id = $1 RETURNING is_blocked",
+        req.target_user_id
+    )
+    invalidate_user(req.target_user_id)
     return {"status": "ok", "is_blocked": new_status}
 
 @app.post("/api/admin/delete_user")
-async def delete_user_admin(req: AdminRequest):
-    admin = supabase.table("users").select("username").eq("id", req.admin_id).single().execute()
-    if not admin.data or admin.data['username'] != ADMIN_USERNAME:
+async def delete_user_admin(req: AdminRequest, pool: asyncpg.Pool = Depends(get_pool)):
+    if req.admin_id != await resolve_admin_id():
         raise HTTPException(403, "Access Denied")
     
     if req.target_user_id == req.admin_id: return {"status": "error"}
 
-    supabase.table("items").delete().eq("user_id", req.target_user_id).execute()
-    supabase.table("users").delete().eq("id", req.target_user_id).execute()
+    # One statement: a single round-trip, and the user never outlives a half-deleted library
+    await pool.execute(
+        "WITH items_gone AS (DELETE FROM items WHERE user_id = $1) DELETE FROM users WHERE id = $1",
+        req.target_user_id
+    )
+    invalidate_files(req.target_user_id)
+    invalidate_user(req.target_user_id)
     return {"status": "ok"}
 
 
 # --- API ENDPOINTS: CLIENT ---
 
+# Columns the web client reads from file listings
+ITEM_COLS = "id, name, type, file_id, size, parent_id, created_at"
+
+def encode_rows(rows, **extra) -> bytes:
+    """Encodes asyncpg rows as JSON; with `extra` fields, as {"items": [...], **extra}.
+
+    asyncpg returns ids as its own UUID subclass, which orjson does not accept
+    natively, so they fall back to str().
+    """
+    items = [dict(r) for r in rows]
+    return orjson.dumps({"items": items, **extra} if extra else items, default=str)
+
+# /api/files filters; 'folder' takes the folder id as $2
+FILES_SCOPES = {
+    'global': "type <> 'folder'",
+    'folders': "type = 'folder'",
+    'folder': "parent_id = $2",
+    'root': "parent_id IS NULL",
+}
+
+def build_files_sql(scope: str, with_cursor: bool, with_limit: bool) -> str:
+    sql = f"SELECT {ITEM_COLS} FROM items WHERE user_id = $1 AND {FILES_SCOPES[scope]}"
+    n = 3 if scope == 'folder' else 2  # next free placeholder
+    if with_cursor:
+        sql += f" AND (type, created_at, id) < (${n}, ${n + 1}, ${n + 2})"
+        n += 3
+    sql += " ORDER BY type DESC, created_at DESC, id DESC"
+    if with_limit: sql += f" LIMIT ${n}"
+    return sql
+
+# Every listing variant is built once at import: (scope, with_cursor, with_limit) -> SQL
+FILES_SQL = {
+    (scope, with_cursor, with_limit): build_files_sql(scope, with_cursor, with_limit)
+    for scope in FILES_SCOPES for with_cursor in (False, True) for with_limit in (False, True)
+}
+
+# Aggregated in Postgres so only one row crosses the wire regardless of library size;
+# `kind` is a generated column, so no names are matched at query time
+PROFILE_STATS_SQL = """
+SELECT
+    COUNT(*) FILTER (WHERE kind <> 'folder') AS total_files,
+    COALESCE(SUM(size), 0) AS total_size_bytes,
+    COUNT(*) FILTER (WHERE kind = 'photo') AS photos,
+    COUNT(*) FILTER (WHERE kind = 'video') AS videos,
+    COUNT(*) FILTER (WHERE kind = 'doc') AS docs,
+    COUNT(*) FILTER (WHERE kind = 'folder') AS folders
+FROM items
+WHERE user_id = $1
+"""
+
 @app.get("/api/profile")
-async def get_profile_stats(user_id: int):
-    check_is_blocked(user_id)
+async def get_profile_stats(user_id: int, pool: asyncpg.Pool = Depends(get_pool)):
+    await check_is_blocked(user_id)
     try:
-        res = supabase.table("items").select("type, name, size").eq("user_id", user_id).execute()
-        items = res.data
-        total_files = 0; total_size_bytes = 0
-        count_photos = 0; count_videos = 0; count_docs = 0; count_folders = 0
-        
-        for i in items:
-            total_size_bytes += (i['size'] or 0)
-            if i['type'] == 'folder': count_folders += 1
-            else:
-                total_files += 1
-                name = i['name'].lower()
-                if name.endswith(('.jpg', '.jpeg', '.png')): count_photos += 1
-                elif name.endswith(('.mp4', '.mov')): count_videos += 1
-                else: count_docs += 1
-        
-        total_size_mb = round(total_size_bytes / (1024 * 1024), 2)
+        stats = await retry_db(lambda: pool.fetchrow(PROFILE_STATS_SQL, user_id))
+        total_size_mb = round(stats['total_size_bytes'] / (1024 * 1024), 2)
         return {
-            "total_files": total_files,
+            "total_files": stats['total_files'],
             "total_size_mb": total_size_mb,
-            "counts": {"photos": count_photos, "videos": count_videos, "docs": count_docs, "folders": count_folders}
+            "counts": {"photos": stats['photos'], "videos": stats['videos'], "docs": stats['docs'], "folders": stats['folders']}
         }
+    except DB_UNAVAILABLE:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail="Stats error")
 
-@app.get("/api/files")
-async def get_files(user_id: int, folder_id: str = None, mode: str = 'strict'):
-    check_is_blocked(user_id)
-    query = supabase.table("items").select("*").eq("user_id", user_id)
-    if mode == 'global': query = query.neq("type", "folder")
-    elif mode == 'folders': query = query.eq("type", "folder")
-    elif folder_id and folder_id != "null" and folder_id != "root": query = query.eq("parent_id", folder_id)
-    else: query = query.is_("parent_id", "null")
-    query = query.order("type", desc=True).order("created_at", desc=True)
-    return query.execute().data
+# The cursor is "<type>_<created_at>_<id>" of the last item on the previous page,
+# base64url-encoded so the "+" of the UTC offset survives an unencoded query string
+def encode_cursor(row) -> str:
+    raw = f"{row['type']}_{row['created_at'].isoformat()}_{row['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).rstrip(b"=").decode()
+
+def decode_cursor(cursor: str) -> list:
+    """Returns [type, created_at, id] for the keyset query; raises ValueError if malformed."""
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    c_type, c_created, c_id = raw.split("_", 2)
+    if c_type not in ('file', 'folder'): raise ValueError(c_type)
+    return [c_type, datetime.fromisoformat(c_created), uuid.UUID(c_id)]
+
+@app.get("/api/files", response_model=None)
+async def get_files(
+    user_id: int,
+    folder_id: str = None,
+    mode: str = 'strict',
+    cursor: str = None,
+    limit: Optional[int] = Query(None, ge=1, le=200),
+    pool: asyncpg.Pool = Depends(get_pool),
+):
+    """Lists items; with `limit` set, returns one keyset page and a `next_cursor`.
+
+    Rows are encoded straight to JSON bytes by encode_rows(), skipping FastAPI's
+    jsonable_encoder pass; the cache keeps those bytes.
+    """
+    await check_is_blocked(user_id)
+    cache_key = (folder_id, mode, cursor, limit)
+    cached = get_cached_files(user_id, cache_key)
+    if cached is not None: return Response(content=cached, media_type="application/json")
+
+    args = [user_id]
+    if mode in ('global', 'folders'): scope = mode
+    elif folder_id and folder_id != "null" and folder_id != "root":
+        scope = 'folder'
+        args.append(folder_id)
+    else: scope = 'root'
+
+    if cursor:
+        try: args += decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    sql = FILES_SQL[scope, bool(cursor), limit is not None]
+
+    if limit is None:
+        body = encode_rows(await retry_db(lambda: pool.fetch(sql, *args)))
+        cache_files(user_id, cache_key, body)
+        return Response(content=body, media_type="application/json")
+
+    args.append(limit)
+    rows = await retry_db(lambda: pool.fetch(sql, *args))
+    next_cursor = None
+    if len(rows) == limit: next_cursor = encode_cursor(rows[-1])
+    body = encode_rows(rows, next_cursor=next_cursor)
+    cache_files(user_id, cache_key, body)
+    return Response(content=body, media_type="application/json")
 
 @app.post("/api/delete_all")
-async def delete_all_data(req: DeleteAllRequest):
-    check_is_blocked(req.user_id)
+async def delete_all_data(req: DeleteAllRequest, pool: asyncpg.Pool = Depends(get_pool)):
+    await check_is_blocked(req.user_id)
     try:
-        supabase.table("items").delete().eq("user_id", req.user_id).execute()
+        await pool.execute("DELETE FROM items WHERE user_id = $1", req.user_id)
+        invalidate_files(req.user_id)
         return {"status": "ok"}
+    except DB_UNAVAILABLE:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/create_folder")
-async def create_folder(req: FolderRequest):
-    check_is_blocked(req.user_id)
+async def create_folder(req: FolderRequest, pool: asyncpg.Pool = Depends(get_pool)):
+    await check_is_blocked(req.user_id)
     try:
         parent = req.parent_id
         if parent == "null" or parent == "": parent = None
-        new_folder = {"user_id": req.user_id, "name": req.name, "type": "folder", "parent_id": parent}
-        supabase.table("items").insert(new_folder).execute()
+        await pool.execute(
+            "INSERT INTO items (user_id, name, type, parent_id) VALUES ($1, $2, 'folder', $3)",
+            req.user_id, req.name, parent
+        )
+        invalidate_files(req.user_id)
         return {"status": "ok"}
+    except DB_UNAVAILABLE:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/rename")
-async def rename_item(req: RenameRequest):
+async def rename_item(req: RenameRequest, pool: asyncpg.Pool = Depends(get_pool)):
     try:
-        supabase.table("items").update({"name": req.new_name}).eq("id", req.item_id).execute()
+        owner = await pool.fetchval("UPDATE items SET name = $1 WHERE id = $2 RETURNING user_id", req.new_name, req.item_id)
+        invalidate_files(owner)
         return {"status": "ok"}
+    except DB_UNAVAILABLE:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/delete")
-async def delete_item(req: ItemRequest):
+async def delete_item(req: ItemRequest, pool: asyncpg.Pool = Depends(get_pool)):
     """Normal deletion: if it's a folder, files are moved to the root."""
     try:
-        item = supabase.table("items").select("type").eq("id", req.item_id).execute()
-        if item.data and item.data[0]['type'] == 'folder':
-            supabase.table("items").update({"parent_id": None}).eq("parent_id", req.item_id).execute()
-        supabase.table("items").delete().eq("id", req.item_id).execute()
+        # Detaching children is a no-op for files, so no type lookup is needed
+        owner = await pool.fetchval(
+            "WITH detached AS (UPDATE items SET parent_id = NULL WHERE parent_id = $1) "
+            "DELETE FROM items WHERE id = $1 RETURNING user_id",
+            req.item_id
+        )
+        invalidate_files(owner)
         return {"status": "deleted"}
+    except DB_UNAVAILABLE:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Collects the folder and all its descendants server-side and deletes them in one statement
+DELETE_SUBTREE_SQL = """
+WITH RECURSIVE subtree AS (
+    SELECT id, user_id FROM items WHERE id = $1
+    UNION ALL
+    SELECT i.id, i.user_id FROM items i JOIN subtree s ON i.parent_id = s.id AND i.user_id = s.user_id
+)
+DELETE FROM items WHERE id IN (SELECT id FROM subtree)
+RETURNING user_id
+"""
+
 @app.post("/api/delete_folder_recursive")
-async def delete_folder_recursive_api(req: ItemRequest):
+async def delete_folder_recursive_api(req: ItemRequest, pool: asyncpg.Pool = Depends(get_pool)):
     """Recursively deletes a folder with all its contents."""
     try:
-        async def recursive_del(folder_id):
-             children = supabase.table("items").select("id, type").eq("parent_id", folder_id).execute().data
-             for child in children:
-                 if child['type'] == 'folder':
-                     await recursive_del(child['id'])
-                 else:
-                     supabase.table("items").delete().eq("id", child['id']).execute()
-             supabase.table("items").delete().eq("id", folder_id).execute()
-
-        await recursive_del(req.item_id)
+        owner = await pool.fetchval(DELETE_SUBTREE_SQL, req.item_id)
+        invalidate_files(owner)
         return {"status": "deleted_recursive"}
+    except DB_UNAVAILABLE:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/download")
-async def download_file(req: DownloadRequest):
+async def download_file(req: DownloadRequest, pool: asyncpg.Pool = Depends(get_pool)):
     target_id = req.recipient_id if req.recipient_id else req.user_id
     
-    if target_id != req.user_id:
-        try:
-            admin_check = supabase.table("users").select("username").eq("id", target_id).single().execute()
-            if not admin_check.data or admin_check.data['username'] != ADMIN_USERNAME:
-                raise HTTPException(status_code=403, detail="Access Denied: Only admin can redirect downloads")
-        except:
-            raise HTTPException(status_code=403, detail="Access Denied")
+    if target_id != req.user_id and target_id != await resolve_admin_id():
+        raise HTTPException(status_code=403, detail="Access Denied: Only admin can redirect downloads")
 
     if target_id == req.user_id:
-        check_is_blocked(req.user_id)
+        await check_is_blocked(req.user_id)
+
+    if not take_token(req.user_id):
+        raise HTTPException(status_code=429, detail="Too Many Requests", headers={"Retry-After": str(USER_RATE_RETRY_AFTER)})
 
     try:
-        is_photo = req.file_name.lower().endswith(('.jpg', '.jpeg', '.png'))
-        is_video = req.file_name.lower().endswith(('.mp4', '.mov'))
-        
-        if is_photo: await bot.send_photo(target_id, req.file_id, caption="📸")
-        elif is_video: await bot.send_video(target_id, req.file_id, caption="🎥")
-        else: await bot.send_document(target_id, req.file_id, caption="📄")
-        
+        await send_file(target_id, req.file_id, req.file_name, caption=DOWNLOAD_CAPTIONS[file_kind(req.file_name)])
         return {"status": "ok"}
+    except TelegramRetryAfter as e:
+        # Still rate-limited after every retry: nothing was sent
+        raise HTTPException(status_code=429, detail="Too Many Requests", headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Transient upstream failures must not be cached, or one blip would stick as a broken preview
+NO_STORE = {"Cache-Control": "no-store"}
+# Bounds connecting and each read, but not the whole (streamed) transfer
+PREVIEW_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=10)
+
 @app.get("/api/preview/{file_id}")
-async def get_preview(file_id: str):
+async def get_preview(
+    file_id: str,
+    if_none_match: Optional[str] = Header(None),
+    http: aiohttp.ClientSession = Depends(get_http),
+):
+    # A file_id always refers to the same bytes, so it doubles as a strong ETag
+    etag = f'"{file_id}"'
+    cache_headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if if_none_match and etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=cache_headers)
+
+    resp = None
     try:
-        file_info = await bot.get_file(file_id)
-        url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp.status != 200: raise HTTPException(status_code=404)
-                content = await resp.read()
-                return Response(content=content, media_type="image/jpeg")
-    except Exception as e:
+        file_path = await resolve_file_path(file_id)
+        resp = await http.get(TG_FILE_PREFIX + file_path, timeout=PREVIEW_TIMEOUT)
+        if resp.status != 200:
+            resp.release()
+            if resp.status == 404: raise HTTPException(status_code=404)
+            raise HTTPException(status_code=502, headers=NO_STORE)
+        # The first chunk is read up front so the real format can be sniffed from its magic bytes
+        head = await resp.content.read(64 * 1024)
+    except TelegramBadRequest:
+        # Telegram rejects unknown or expired file_ids: the only permanent failure
         raise HTTPException(status_code=404)
+    except asyncio.TimeoutError:
+        if resp: resp.release()
+        raise HTTPException(status_code=504, headers=NO_STORE)
+    except (aiohttp.ClientError, TelegramNetworkError):
+        if resp: resp.release()
+        raise HTTPException(status_code=502, headers=NO_STORE)
+
+    async def body():
+        # The upstream response stays open until the client has received every chunk
+        try:
+            yield head
+            async for chunk in resp.content.iter_chunked(64 * 1024):
+                yield chunk
+        finally:
+            resp.release()
+
+    headers = dict(cache_headers)
+    if resp.content_length is not None: headers["Content-Length"] = str(resp.content_length)
+    media_type = sniff_media_type(head)
+    if media_type is None:
+        # Telegram labels some files as octet-stream; previews are images, so keep JPEG as the fallback
+        media_type = resp.content_type if resp.content_type != "application/octet-stream" else "image/jpeg"
+    return StreamingResponse(body(), media_type=media_type, headers=headers)
 
 @app.post("/api/move_file")
-async def move_file(req: MoveRequest):
+async def move_file(req: MoveRequest, pool: asyncpg.Pool = Depends(get_pool)):
     try:
-        supabase.table("items").update({"parent_id": req.folder_id}).eq("id", req.file_id).execute()
+        owner = await pool.fetchval("UPDATE items SET parent_id = $1 WHERE id = $2 RETURNING user_id", req.folder_id, req.file_id)
+        invalidate_files(owner)
         return {"status": "ok"}
+    except DB_UNAVAILABLE:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -528,9 +1142,21 @@ async def generate_invoice(req: InvoiceRequest):
         )
         return {"link": link}
     except Exception as e:
-        print(f"Error generating invoice: {e}")
+        log.exception("Error generating invoice")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/")
 async def root():
-    return {"message": "Tg Cloud v3.0"}
\ No newline at end of file
+    return {"message": "Tg Cloud v3.0"}
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8000)),
+        loop="uvloop",
+        http="httptools",
+        workers=WEB_WORKERS,
+        backlog=2048,
+    )
\ No newline at end of file
@@ -0,0 +1,11 @@
+-- Indexes backing GET /api/files: filter on (user_id, parent_id), order by
+-- type DESC, created_at DESC, id DESC (id breaks ties for keyset pagination).
+
+CREATE INDEX IF NOT EXISTS items_listing_idx
+    ON items (user_id, parent_id, type DESC, created_at DESC, id DESC)
+    INCLUDE (name, file_id, size);
+
+-- Root folder listing (parent_id IS NULL) is the most frequent case.
+CREATE INDEX IF NOT EXISTS items_root_idx
+    ON items (user_id, type DESC, created_at DESC, id DESC)
+    WHERE parent_id IS NULL;
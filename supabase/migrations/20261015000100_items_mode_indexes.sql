@@ -0,0 +1,10 @@
+-- Partial indexes for the GET /api/files modes that ignore parent_id:
+-- mode=global lists every file of a user, mode=folders lists every folder.
+
+CREATE INDEX IF NOT EXISTS items_user_files_idx
+    ON items (user_id, type DESC, created_at DESC, id DESC)
+    WHERE type <> 'folder';
+
+CREATE INDEX IF NOT EXISTS items_user_folders_idx
+    ON items (user_id, created_at DESC, id DESC)
+    WHERE type = 'folder';
@@ -0,0 +1,7 @@
+-- Child lookups by parent_id alone: the recursive subtree CTEs and detaching a
+-- deleted folder's children. The listing indexes lead with user_id, so they
+-- cannot serve these.
+
+CREATE INDEX IF NOT EXISTS items_parent_idx
+    ON items (parent_id)
+    WHERE parent_id IS NOT NULL;
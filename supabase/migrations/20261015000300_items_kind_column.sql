@@ -0,0 +1,11 @@
+-- File kind derived once on write instead of regex-matching every name on each
+-- GET /api/profile. Mirrors EXT_KIND / file_kind() in main.py.
+
+ALTER TABLE items ADD COLUMN IF NOT EXISTS kind text GENERATED ALWAYS AS (
+    CASE
+        WHEN type = 'folder' THEN 'folder'
+        WHEN lower(name) ~ '\.(jpg|jpeg|png)$' THEN 'photo'
+        WHEN lower(name) ~ '\.(mp4|mov)$' THEN 'video'
+        ELSE 'doc'
+    END
+) STORED;
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# main.py builds the Bot at import time, which only checks the token's format
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
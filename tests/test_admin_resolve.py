@@ -0,0 +1,40 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import GetChat
+
+import main
+
+
+class FakePool:
+    def __init__(self, ids):
+        self.ids = ids
+
+    async def fetch(self, query, username, limit):
+        return [{"id": i} for i in self.ids[:limit]]
+
+
+@pytest.fixture
+def resolve(monkeypatch):
+    def setup(ids, usernames):
+        async def get_chat(chat_id):
+            if chat_id not in usernames: raise TelegramBadRequest(method=GetChat(chat_id=chat_id), message="chat not found")
+            return SimpleNamespace(username=usernames[chat_id])
+
+        monkeypatch.setattr(main, "ADMIN_ID", None)
+        monkeypatch.setattr(main, "_admin_resolved_at", None)
+        monkeypatch.setattr(main, "get_pool", lambda: FakePool(ids))
+        monkeypatch.setattr(main.bot, "get_chat", get_chat)
+        return asyncio.run(main.resolve_admin_id())
+    return setup
+
+
+def test_resolve_admin_id_skips_first_name_impostor(resolve):
+    # Row 1 got ADMIN_USERNAME from its first_name; row 2 owns the @username
+    assert resolve([1, 2], {1: None, 2: main.ADMIN_USERNAME.capitalize()}) == 2
+
+
+def test_resolve_admin_id_refuses_unverified_rows(resolve):
+    assert resolve([1, 3], {1: "someone_else"}) is None
@@ -0,0 +1,61 @@
+import uuid
+from datetime import datetime, timezone
+
+import orjson
+import pytest
+from asyncpg.pgproto import pgproto
+
+import main
+
+
+def make_row(**overrides):
+    # Values typed the way asyncpg decodes an items row
+    row = {
+        "id": pgproto.UUID(str(uuid.uuid4())),
+        "name": "photo.jpg",
+        "type": "file",
+        "file_id": "AgACAgIAAxkBAAI",
+        "size": 1024,
+        "parent_id": pgproto.UUID(str(uuid.uuid4())),
+        "created_at": datetime(2026, 10, 15, 12, 0, tzinfo=timezone.utc),
+    }
+    row.update(overrides)
+    return row
+
+
+def test_encode_rows_serializes_asyncpg_uuids():
+    row = make_row()
+    assert orjson.loads(main.encode_rows([row])) == [{
+        "id": str(row["id"]),
+        "name": "photo.jpg",
+        "type": "file",
+        "file_id": "AgACAgIAAxkBAAI",
+        "size": 1024,
+        "parent_id": str(row["parent_id"]),
+        "created_at": "2026-10-15T12:00:00+00:00",
+    }]
+
+
+def test_encode_rows_page_shape():
+    row = make_row(parent_id=None)
+    page = orjson.loads(main.encode_rows([row], next_cursor="file_x_y"))
+    assert page["next_cursor"] == "file_x_y"
+    assert page["items"][0]["id"] == str(row["id"])
+    assert page["items"][0]["parent_id"] is None
+
+
+def test_encode_rows_empty_listing():
+    assert main.encode_rows([]) == b"[]"
+
+
+def test_cursor_round_trips_and_is_url_safe():
+    row = make_row()
+    cursor = main.encode_cursor(row)
+    assert all(c.isalnum() or c in "-_" for c in cursor)
+    assert main.decode_cursor(cursor) == ["file", row["created_at"], uuid.UUID(str(row["id"]))]
+
+
+def test_decode_cursor_rejects_malformed():
+    for cursor in ("not base64!", main.encode_cursor(make_row(type="x"))):
+        with pytest.raises(ValueError):
+            main.decode_cursor(cursor)
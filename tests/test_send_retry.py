@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def fast_pacing(monkeypatch):
+    monkeypatch.setattr(main, "TG_CHAT_INTERVAL", 0.05)
+    # Keeps the overall slot negligible, so only the per-chat gap is measured
+    monkeypatch.setattr(main, "TG_SEND_RATE", 1e6)
+    monkeypatch.setattr(main, "_next_send_at", 0.0)
+    monkeypatch.setattr(main, "_next_chat_send_at", {})
+
+
+def retry_after():
+    return TelegramRetryAfter(method=SendMessage(chat_id=1, text="x"), message="Too Many Requests", retry_after=0)
+
+
+def test_send_with_retry_reraises_after_last_attempt():
+    calls = []
+
+    async def send():
+        calls.append(1)
+        raise retry_after()
+
+    with pytest.raises(TelegramRetryAfter):
+        asyncio.run(main.send_with_retry(1, send, retries=3))
+    assert len(calls) == 3
+
+
+def test_send_with_retry_returns_after_transient_retry_after():
+    calls = []
+
+    async def send():
+        calls.append(1)
+        if len(calls) == 1: raise retry_after()
+        return "sent"
+
+    assert asyncio.run(main.send_with_retry(1, send)) == "sent"
+    assert len(calls) == 2
+
+
+def test_throttle_send_spaces_sends_per_chat_only():
+    async def run():
+        start = time.monotonic()
+        await main.throttle_send(1)
+        await main.throttle_send(2)
+        other_chat = time.monotonic() - start
+        await main.throttle_send(1)
+        return other_chat, time.monotonic() - start
+
+    other_chat, same_chat = asyncio.run(run())
+    assert other_chat < main.TG_CHAT_INTERVAL
+    assert same_chat >= main.TG_CHAT_INTERVAL
+
+
+def test_send_folder_contents_keeps_tree_order(monkeypatch):
+    sent = []
+
+    async def fake_send_file(chat_id, file_id, name, caption=None, retries=3):
+        # Earlier files take longer, so concurrent sends would finish out of order
+        await asyncio.sleep(0.01 * (3 - len(sent)) if len(sent) < 3 else 0)
+        sent.append(name)
+
+    async def fake_send_with_retry(chat_id, send, retries=3):
+        send().close()
+        sent.append("header")
+
+    monkeypatch.setattr(main, "send_file", fake_send_file)
+    monkeypatch.setattr(main, "send_with_retry", fake_send_with_retry)
+    tree = {
+        "root": [
+            {"id": "sub", "type": "folder", "name": "sub"},
+            {"id": 1, "type": "file", "name": "a.jpg", "file_id": "A"},
+            {"id": 2, "type": "file", "name": "b.jpg", "file_id": "B"},
+        ],
+        "sub": [{"id": 3, "type": "file", "name": "c.jpg", "file_id": "C"}],
+    }
+    asyncio.run(main.send_folder_contents(1, tree, "root"))
+    assert sent == ["header", "c.jpg", "a.jpg", "b.jpg"]